@@ -1,11 +1,15 @@
 # load_to_postgres.py
 
-import io
 import os
 import sys
 import logging
+import struct
 import tempfile
-import psycopg2
+import functools
+from psycopg.copy import QueuedLibpqWriter
+from psycopg_pool import ConnectionPool
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
 from dotenv import load_dotenv
@@ -14,6 +18,51 @@ load_dotenv()
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# PostgreSQL binary COPY framing: signature, flags, header extension length
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH_US = 946684800000000  # 2000-01-01 in Unix epoch microseconds
+
+# One binary COPY tuple of tmp_breadcrumb: field count, then (length, value) per column
+BREADCRUMB_PGCOPY_DTYPE = np.dtype([
+    ("ncols", ">i2"),
+    ("tstamp_len", ">i4"), ("tstamp", ">i8"),
+    ("latitude_len", ">i4"), ("latitude", ">f8"),
+    ("longitude_len", ">i4"), ("longitude", ">f8"),
+    ("speed_len", ">i4"), ("speed", ">f8"),
+    ("trip_id_len", ">i4"), ("trip_id", ">i4"),
+])
+
+# Nullable breadcrumb columns; a NaN in any of them is sent as NULL, as the CSV load did
+BREADCRUMB_NULLABLE = ("latitude", "longitude", "speed")
+
+# Source column (matched case-insensitively) -> staged column, in COPY order
+BREADCRUMB_COLUMNS = {
+    'tstamp': 'tstamp',
+    'gps_latitude': 'latitude',
+    'gps_longitude': 'longitude',
+    'speed': 'speed',
+    'event_no_trip': 'trip_id',
+}
+TRIP_COLUMNS = {
+    'event_no_trip': 'trip_id',
+    'vehicle_id': 'vehicle_id',
+    'service_key': 'service_key',
+}
+
+# Rows serialized per COPY write
+COPY_CHUNKSIZE = 50_000
+
+# Concurrent COPY connections (and staging tables) used for the breadcrumb load
+COPY_WORKERS = 4
+
+# Advisory lock key held by a breadcrumb load for its whole transaction; it serializes loads
+# because they all share the stg_breadcrumb_<i> staging tables
+BREADCRUMB_LOAD_LOCK = 72_706_101
+
+# Pooled connections: the COPY workers plus the coordinating connection, with headroom
+POOL_MAX_SIZE = 8
+
 def require_env(var):
     value = os.getenv(var)
     if value is None:
@@ -21,6 +70,24 @@ def require_env(var):
     return value
 
 
+# Process-wide pool, opened on first use so importing this module needs no database.
+# Loads only change settings with SET LOCAL and use ON COMMIT DROP temp tables, so
+# connections go back to the pool clean.
+@functools.lru_cache(maxsize=None)
+def get_pool():
+    return ConnectionPool(
+        kwargs={
+            "dbname": require_env("DB_NAME"),
+            "user": require_env("DB_USER"),
+            "password": require_env("DB_PASSWORD"),
+            "host": require_env("DB_HOST"),
+        },
+        min_size=1,
+        max_size=POOL_MAX_SIZE,
+        open=True
+    )
+
+
 def create_tables(conn):
     with conn.cursor() as cur:
         cur.execute("""
@@ -45,6 +112,99 @@ def create_tables(conn):
     conn.commit()
 
 
+# Create tables and indexes once per process instead of on every load
+@functools.lru_cache(maxsize=None)
+def init_schema():
+    with get_pool().connection() as conn:
+        create_tables(conn)
+        create_stop_event_table(conn)
+        with conn.cursor() as cur:
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_vehicle ON trip(vehicle_id);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_breadcrumb_trip ON breadcrumb(trip_id);")
+
+            # One unlogged staging table per COPY worker; regular tables so the coordinating
+            # connection can read what the workers committed
+            for i in range(COPY_WORKERS):
+                cur.execute(f"""
+                    CREATE UNLOGGED TABLE IF NOT EXISTS stg_breadcrumb_{i} (
+                        tstamp TIMESTAMP,
+                        latitude DOUBLE PRECISION,
+                        longitude DOUBLE PRECISION,
+                        speed DOUBLE PRECISION,
+                        trip_id INTEGER
+                    );
+                """)
+        conn.commit()
+
+
+# Pick and rename one table's columns with a single copy of just those columns
+def select_columns(df: pd.DataFrame, columns: dict) -> pd.DataFrame:
+    source = {col.lower(): col for col in df.columns}
+    selected = df[[source[col] for col in columns]]
+    selected.columns = list(columns.values())
+    return selected
+
+
+# Encode a slice of breadcrumb rows as binary COPY tuples straight from the NumPy columns
+def breadcrumb_to_pgcopy(breadcrumb_df: pd.DataFrame) -> bytes:
+    rows = np.empty(len(breadcrumb_df), dtype=BREADCRUMB_PGCOPY_DTYPE)
+    rows["ncols"] = 5
+    for name in ("tstamp", "latitude", "longitude", "speed", "trip_id"):
+        rows[f"{name}_len"] = BREADCRUMB_PGCOPY_DTYPE[name].itemsize
+
+    tstamp_us = breadcrumb_df["tstamp"].to_numpy().astype("datetime64[us]").astype(np.int64)
+    rows["tstamp"] = tstamp_us - PG_EPOCH_US
+    rows["latitude"] = breadcrumb_df["latitude"].to_numpy(np.float64)
+    rows["longitude"] = breadcrumb_df["longitude"].to_numpy(np.float64)
+    rows["speed"] = breadcrumb_df["speed"].to_numpy(np.float64)
+    rows["trip_id"] = breadcrumb_df["trip_id"].to_numpy(np.int32)
+
+    nulls = {name: np.isnan(rows[name]) for name in BREADCRUMB_NULLABLE}
+    if not any(mask.any() for mask in nulls.values()):
+        return rows.tobytes()
+
+    # A NULL field is a length of -1 with no value bytes, so these rows are variable-width:
+    # mark the NULL values' bytes as dropped and keep the rest of each row in order
+    keep = np.ones((len(rows), rows.dtype.itemsize), dtype=bool)
+    for name, mask in nulls.items():
+        rows[f"{name}_len"][mask] = -1
+        offset = BREADCRUMB_PGCOPY_DTYPE.fields[name][1]
+        keep[mask, offset:offset + BREADCRUMB_PGCOPY_DTYPE[name].itemsize] = False
+    return rows.view(np.uint8).reshape(len(rows), -1)[keep].tobytes()
+
+
+# Write a complete binary COPY stream for breadcrumb_df, one chunk at a time
+def write_breadcrumb_pgcopy(breadcrumb_df: pd.DataFrame, f):
+    f.write(PGCOPY_HEADER)
+    for start in range(0, len(breadcrumb_df), COPY_CHUNKSIZE):
+        f.write(breadcrumb_to_pgcopy(breadcrumb_df.iloc[start:start + COPY_CHUNKSIZE]))
+    f.write(PGCOPY_TRAILER)
+
+
+# Run COPY ... FROM STDIN with data produced by write(copy). The queued writer sends
+# blocks to the server from a background thread, so serialization overlaps network I/O;
+# an exception in write() aborts the COPY instead of committing a short load.
+def copy_from_writer(cur, sql, write):
+    with cur.copy(sql, writer=QueuedLibpqWriter(cur)) as copy:
+        write(copy)
+
+
+# COPY one breadcrumb partition into its own unlogged staging table on a separate connection.
+# Only called while load_breadcrumb_data holds BREADCRUMB_LOAD_LOCK, so no other load can
+# truncate or read the staging tables in between. The worker cannot take the lock itself:
+# the coordinating transaction holds it until after the workers finish.
+def copy_breadcrumb_partition(i, part_df: pd.DataFrame):
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        # Truncating in this transaction is what makes COPY FREEZE legal here
+        cur.execute(f"TRUNCATE stg_breadcrumb_{i};")
+        copy_from_writer(
+            cur,
+            f"COPY stg_breadcrumb_{i} (tstamp, latitude, longitude, speed, trip_id) FROM STDIN WITH (FORMAT BINARY, FREEZE TRUE)",
+            lambda f: write_breadcrumb_pgcopy(part_df, f)
+        )
+        conn.commit()
+
+
 def load_breadcrumb_data(df: pd.DataFrame, logger=None):
     if logger is None:
         logger = logging.getLogger(__name__)  # fallback
@@ -54,110 +214,95 @@ def load_breadcrumb_data(df: pd.DataFrame, logger=None):
         logger.addHandler(handler)
 
     logger.info("Loading data to PostgreSQL...")
-    df.columns = df.columns.str.lower()
-    df["tstamp"] = pd.to_datetime(df["tstamp"])
 
     # Prepare trip and breadcrumb DataFrames
-    breadcrumb_df = df.rename(columns={
-        'gps_latitude': 'latitude',
-        'gps_longitude': 'longitude',
-        'event_no_trip': 'trip_id'
-    })[['tstamp', 'latitude', 'longitude', 'speed', 'trip_id']]
+    breadcrumb_df = select_columns(df, BREADCRUMB_COLUMNS)
+    trip_df = select_columns(df, TRIP_COLUMNS)
 
-    trip_df = df.rename(columns={
-        'event_no_trip': 'trip_id'
-    })[['trip_id', 'vehicle_id', 'service_key']]
+    # The subscriber already hands over datetime64 values; only parse when given strings
+    if not pd.api.types.is_datetime64_any_dtype(breadcrumb_df["tstamp"]):
+        breadcrumb_df["tstamp"] = pd.to_datetime(breadcrumb_df["tstamp"], format="ISO8601", cache=True)
 
+    # One row per trip keeps the trip COPY to a handful of rows instead of one per breadcrumb.
+    # Duplicate breadcrumbs are left to the INSERT's ON CONFLICT, which skips in-batch repeats.
+    trip_df = trip_df.drop_duplicates(subset="trip_id")
     trip_df['route_id'] = -1
     trip_df['direction'] = '0'
 
-    trip_df = trip_df.drop_duplicates(subset="trip_id")
-    breadcrumb_df.drop_duplicates(subset=["tstamp", "trip_id"], inplace=True)
-    breadcrumb_df = breadcrumb_df[breadcrumb_df['trip_id'].isin(trip_df['trip_id'])]
+    # Primary-key columns can't be NULL, so drop rows missing one; NULL values elsewhere are encoded as NULL
+    initial_len = len(breadcrumb_df)
+    breadcrumb_df = breadcrumb_df.dropna(subset=["tstamp", "trip_id"])
+    removed = initial_len - len(breadcrumb_df)
+    logger.info(f"Removed {removed} breadcrumb rows with null tstamp or trip_id.")
 
     if breadcrumb_df.empty:
         logger.error("No breadcrumb data to load.")
         return 0
 
-    # Convert to in-memory CSV buffers
-    trip_buf = io.StringIO()
-    breadcrumb_buf = io.StringIO()
-
-    trip_df.to_csv(trip_buf, index=False, header=False,
-                   columns=["trip_id", "route_id", "vehicle_id", "service_key", "direction"])
-    breadcrumb_df.to_csv(breadcrumb_buf, index=False, header=False,
-                         columns=["tstamp", "latitude", "longitude", "speed", "trip_id"])
-
-    # Reset buffer position
-    trip_buf.seek(0)
-    breadcrumb_buf.seek(0)
-
-    # Connect to DB and load data
-    conn = psycopg2.connect(
-        dbname=require_env("DB_NAME"),
-        user=require_env("DB_USER"),
-        password=require_env("DB_PASSWORD"),
-        host=require_env("DB_HOST")
-    )
-    
-    cur = conn.cursor()
-    create_tables(conn)
-
-    # Disable constraints temporarily
-    cur.execute("SET session_replication_role = 'replica';")
-
-    # Create temp tables
-    cur.execute("""
-        CREATE TEMP TABLE tmp_trip (
-            trip_id INTEGER,
-            route_id INTEGER,
-            vehicle_id INTEGER,
-            service_key TEXT,
-            direction TEXT
-        );
-    """)
-    cur.execute("""
-        CREATE TEMP TABLE tmp_breadcrumb (
-            tstamp TIMESTAMP,
-            latitude DOUBLE PRECISION,
-            longitude DOUBLE PRECISION,
-            speed DOUBLE PRECISION,
-            trip_id INTEGER
-        );
-    """)
-
-    # Load in-memory CSV data into temp tables
-    cur.copy_expert("COPY tmp_trip (trip_id, route_id, vehicle_id, service_key, direction) FROM STDIN WITH CSV", trip_buf)
-    cur.copy_expert("COPY tmp_breadcrumb (tstamp, latitude, longitude, speed, trip_id) FROM STDIN WITH CSV", breadcrumb_buf)
-
-    # Count new rows
-    cur.execute("SELECT COUNT(*) FROM tmp_trip")
-    new_trip_rows = cur.fetchone()[0]
-
-    cur.execute("SELECT COUNT(*) FROM tmp_breadcrumb")
-    new_breadcrumb_rows = cur.fetchone()[0]
-
-    # Insert with deduplication
-    cur.execute("""
-        INSERT INTO trip (trip_id, route_id, vehicle_id, service_key, direction)
-        SELECT * FROM tmp_trip
-        ON CONFLICT (trip_id) DO NOTHING;
-    """)
-    cur.execute("""
-        INSERT INTO breadcrumb (tstamp, latitude, longitude, speed, trip_id)
-        SELECT * FROM tmp_breadcrumb
-        ON CONFLICT (tstamp, trip_id) DO NOTHING;
-    """)
+    init_schema()
 
-    conn.commit()
+    # Load everything in one transaction on a pooled connection
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        # Bulk-load setting: don't wait on WAL fsync at commit (a server crash can lose
+        # the last commits but never corrupts the tables)
+        cur.execute("SET LOCAL synchronous_commit = OFF;")
 
-    # Create indexes
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_trip_vehicle ON trip(vehicle_id);")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_breadcrumb_trip ON breadcrumb(trip_id);")
-    conn.commit()
+        # Disable constraints temporarily
+        cur.execute("SET LOCAL session_replication_role = 'replica';")
 
-    cur.close()
-    conn.close()
+        # Wait for any other breadcrumb load to commit before touching the shared staging tables
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (BREADCRUMB_LOAD_LOCK,))
+
+        # Create temp table for trips
+        cur.execute("""
+            CREATE TEMP TABLE tmp_trip (
+                trip_id INTEGER,
+                route_id INTEGER,
+                vehicle_id INTEGER,
+                service_key TEXT,
+                direction TEXT
+            ) ON COMMIT DROP;
+        """)
+
+        # Stream trips as CSV into the temp table. FREEZE writes tuples pre-frozen, which is
+        # allowed because the table was created in this transaction and only we can see it.
+        copy_from_writer(
+            cur,
+            "COPY tmp_trip (trip_id, route_id, vehicle_id, service_key, direction) FROM STDIN WITH (FORMAT CSV, FREEZE TRUE)",
+            lambda f: trip_df.to_csv(f, index=False, header=False, chunksize=COPY_CHUNKSIZE,
+                                     columns=["trip_id", "route_id", "vehicle_id", "service_key", "direction"])
+        )
+
+        # Stream breadcrumbs as binary COPY data, partitioned by trip_id across concurrent connections
+        partition = breadcrumb_df["trip_id"].to_numpy() % COPY_WORKERS
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+            list(executor.map(
+                lambda i: copy_breadcrumb_partition(i, breadcrumb_df[partition == i]),
+                range(COPY_WORKERS)
+            ))
+
+        # Insert with deduplication; rowcount is the number of rows actually added
+        cur.execute("""
+            INSERT INTO trip (trip_id, route_id, vehicle_id, service_key, direction)
+            SELECT * FROM tmp_trip
+            ON CONFLICT (trip_id) DO NOTHING;
+        """)
+        new_trip_rows = cur.rowcount
+
+        # Only keep breadcrumbs whose trip was staged; Postgres resolves this with a hash join
+        staged = " UNION ALL ".join(f"SELECT * FROM stg_breadcrumb_{i}" for i in range(COPY_WORKERS))
+        cur.execute(f"""
+            INSERT INTO breadcrumb (tstamp, latitude, longitude, speed, trip_id)
+            SELECT * FROM ({staged}) AS staged
+            WHERE trip_id IN (SELECT trip_id FROM tmp_trip)
+            ON CONFLICT (tstamp, trip_id) DO NOTHING;
+        """)
+        new_breadcrumb_rows = cur.rowcount
+
+        # Empty the staging tables before releasing the lock so they don't hold the batch until the next load
+        cur.execute(f"TRUNCATE {', '.join(f'stg_breadcrumb_{i}' for i in range(COPY_WORKERS))};")
+
+        conn.commit()
 
     logger.info(f"{new_trip_rows} rows were added to the Trip table.")
     logger.info(f"{new_breadcrumb_rows} rows were added to the Breadcrumb table.")
@@ -185,21 +330,9 @@ def load_stop_event_data(df: pd.DataFrame):
     if not all(col in df.columns for col in required_columns):
         raise ValueError(f"DataFrame must contain columns: {required_columns}")
 
-    df.columns = df.columns.str.lower()
-
-    # Convert DataFrame to in-memory CSV
-    buffer = io.StringIO()
-    df.to_csv(buffer, index=False, header=False)
-    buffer.seek(0)
-
-    with psycopg2.connect(
-        dbname=require_env("DB_NAME"),
-        user=require_env("DB_USER"),
-        password=require_env("DB_PASSWORD"),
-        host=require_env("DB_HOST")
-    ) as conn:
-        create_stop_event_table(conn)
+    init_schema()
 
+    with get_pool().connection() as conn:
         with conn.cursor() as cur:
             # Create temporary table
             cur.execute("""
@@ -209,26 +342,24 @@ def load_stop_event_data(df: pd.DataFrame):
                     route_number INTEGER,
                     service_key TEXT,
                     direction INTEGER
-                );
+                ) ON COMMIT DROP;
             """)
 
-            # Load buffer into temp table
-            cur.copy_expert("""
+            # Stream the DataFrame as tab-delimited CSV into the temp table. CSV quoting covers
+            # fields holding tabs, quotes, newlines or backslashes; empty fields and missing
+            # values are written unquoted, which COPY loads as NULL.
+            copy_from_writer(cur, """
                 COPY tmp_stop_event (trip_id, vehicle_number, route_number, service_key, direction)
-                FROM STDIN WITH CSV
-            """, buffer)
-
-            # Count new data rows
-            cur.execute("SELECT COUNT(*) FROM tmp_stop_event")
-            new_stop_rows = cur.fetchone()[0]
-
+                FROM STDIN WITH (FORMAT CSV, DELIMITER E'\\t', FREEZE TRUE)
+            """, lambda f: df.to_csv(f, sep='\t', index=False, header=False, chunksize=COPY_CHUNKSIZE))
 
-            # Insert into final table with deduplication
+            # Insert into final table with deduplication; rowcount is the number of rows added
             cur.execute("""
                 INSERT INTO stop_event (trip_id, vehicle_number, route_number, service_key, direction)
                 SELECT * FROM tmp_stop_event
                 ON CONFLICT (trip_id, vehicle_number) DO NOTHING;
             """)
+            new_stop_rows = cur.rowcount
 
             # INTEGRATION: Update trip table based on new stop_event rows
             cur.execute("""
@@ -2,8 +2,9 @@ import os
 import json
 import datetime
 import logging
-import urllib.request
+import urllib3
 from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.types import BatchSettings
 from google.oauth2 import service_account
 from concurrent import futures as concurrent_futures
 
@@ -31,10 +32,19 @@ SERVICE_ACCOUNT_FILE = os.path.join(os.path.dirname(__file__), "pubsubkey.json")
 project_id = "trimet-data-pipeline"
 topic_id = "bus-data"
 
+# Let the client bundle many small breadcrumb messages into each publish RPC
+batch_settings = BatchSettings(max_messages=1000, max_bytes=1_000_000, max_latency=0.05)
+publish_timeout = 60  # Seconds to wait for a bus's publishes to be acknowledged
+
+# Fetch buses concurrently over a shared keep-alive connection pool
+max_fetch_workers = 16
+fetch_timeout = 30
+http = urllib3.PoolManager(maxsize=max_fetch_workers)
+
 # Set up Pub/Sub client
 try:
     pubsub_creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
-    publisher = pubsub_v1.PublisherClient(credentials=pubsub_creds)
+    publisher = pubsub_v1.PublisherClient(batch_settings=batch_settings, credentials=pubsub_creds)
     topic_path = publisher.topic_path(project_id, topic_id)
     logging.info("Pub/Sub client initialized successfully.")
     print("Pub/Sub client initialized successfully.")
@@ -65,26 +75,40 @@ def log_error(error, bus_id):
     with open(error_file, 'a') as f:
         f.write(bus_id + '\n')
 
-# Main: Retrieve data for each bus
+# Fetch and decode the breadcrumbs for one bus
+def fetch_bus(bus_id):
+    logging.info(f'Fetching data for Bus {bus_id}')
+    resp = http.request("GET", url + bus_id, timeout=fetch_timeout)
+    if resp.status != 200:
+        raise urllib3.exceptions.HTTPError(f"HTTP {resp.status}")
+    return json.loads(resp.data)
+
+# Main: Retrieve data for each bus, publishing as each fetch completes
 message_count = 0
 
-for bus in vehicles:
-    logging.info(f'Fetching data for Bus {bus}')
-    try:
-        req = urllib.request.urlopen(url + bus)
-        data = json.loads(req.read())
-        
-        for message in data:
-            data_str = json.dumps(message)
+with concurrent_futures.ThreadPoolExecutor(max_workers=max_fetch_workers) as executor:
+    fut_to_bus = {executor.submit(fetch_bus, bus): bus for bus in vehicles}
+
+    for fetch_future in concurrent_futures.as_completed(fut_to_bus):
+        bus = fut_to_bus[fetch_future]
+        try:
+            data = fetch_future.result()
+
             # Data must be a bytestring
-            data_bytes = data_str.encode("utf-8")
-            try:
-                publisher.publish(topic_path, data_bytes)
-                message_count += 1  # Count each message
-            except Exception as pub_e:
-                logging.error(f"Error publishing message for bus {bus}: {pub_e}")
-    except Exception as e:
-        log_error(e, bus)
+            futures = [publisher.publish(topic_path, json.dumps(message).encode("utf-8")) for message in data]
+
+            # Wait once per bus so failures surface and pending futures stay bounded
+            done, not_done = concurrent_futures.wait(futures, timeout=publish_timeout)
+            for future in done:
+                pub_e = future.exception()
+                if pub_e is None:
+                    message_count += 1  # Count each published message
+                else:
+                    logging.error(f"Error publishing message for bus {bus}: {pub_e}")
+            if not_done:
+                logging.error(f"{len(not_done)} messages for bus {bus} not published within {publish_timeout}s")
+        except Exception as e:
+            log_error(e, bus)
 
 logging.info(f"Total Pub/Sub messages published: {message_count}")
 print(f"Total Pub/Sub messages published: {message_count}")
@@ -3,10 +3,14 @@ import os
 import csv
 import datetime
 import logging
-import urllib.request
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.types import BatchSettings
 from google.oauth2 import service_account
-from bs4 import BeautifulSoup
+import lxml.html
+
+TRIP_RE = re.compile(r'TRIP (\d+)')
 
 class LoggerSetup:
     @staticmethod
@@ -37,47 +41,69 @@ class VehicleLoader:
             return [line.strip() for line in f.readlines()]
 
 class StopEventFetcher:
-    def __init__(self, base_url):
+    def __init__(self, base_url, max_workers=16, timeout=30):
         self.base_url = base_url
-
-    def fetch_html(self, vehicle_id):
-        with urllib.request.urlopen(self.base_url + vehicle_id) as response:
-            return response.read().decode('utf-8').strip()
-
-    def parse_tables(self, html):
-        soup = BeautifulSoup(html, 'html.parser')
+        self.timeout = timeout
+        # Shared keep-alive pool, safe to use from the fetch threads
+        self.http = urllib3.PoolManager(maxsize=max_workers)
+
+    def fetch_tree(self, vehicle_id):
+        # Stream the gzip-decoded body straight into lxml instead of buffering it as a str
+        response = self.http.request(
+            "GET", self.base_url + vehicle_id, timeout=self.timeout,
+            headers={"Accept-Encoding": "gzip"}, preload_content=False
+        )
+        try:
+            if response.status != 200:
+                raise urllib3.exceptions.HTTPError(f"HTTP {response.status}")
+            # lxml's C parser; None when the body is empty
+            parser = lxml.html.HTMLParser(encoding='utf-8')
+            return lxml.html.parse(response, parser).getroot()
+        finally:
+            response.release_conn()
+
+    def parse_tables(self, root):
         sections = []
-        h2_elements = soup.find_all('h2')
-        tables = soup.find_all('table')
-
-        for h2, table in zip(h2_elements, tables):
-            match = re.search(r'TRIP (\d+)', h2.text)
-            if match:
-                trip_id = match.group(1)
-                sections.append((trip_id, table))
+        heading = None
+
+        # Single walk in document order, pairing each table with the h2 right before it
+        for el in root.iter('h2', 'table'):
+            if el.tag == 'h2':
+                heading = el.text_content()
+            elif heading is not None:
+                # Cheap substring test before running the regex on non-trip headings
+                match = 'TRIP ' in heading and TRIP_RE.search(heading)
+                if match:
+                    trip_id = match.group(1)
+                    sections.append((trip_id, el))
+                heading = None
 
         return sections
 
 class PubSubClient:
     def __init__(self, service_account_file, project_id, topic_id):
         creds = service_account.Credentials.from_service_account_file(service_account_file)
-        self.publisher = pubsub_v1.PublisherClient(credentials=creds)
+        # Bundle the small per-trip rows into few publish RPCs
+        batch_settings = BatchSettings(max_messages=500, max_latency=0.1)
+        self.publisher = pubsub_v1.PublisherClient(batch_settings=batch_settings, credentials=creds)
         self.topic_path = self.publisher.topic_path(project_id, topic_id)
 
     def publish(self, data):
-        self.publisher.publish(self.topic_path, data.encode('utf-8'))
+        return self.publisher.publish(self.topic_path, data.encode('utf-8'))
 
 class StopEventPublisher:
     def __init__(self, config):
         self.date = datetime.datetime.now()
         self.vehicle_file = config['vehicle_file']
         self.base_url = config['base_url']
+        self.max_workers = config.get('max_workers', 16)
+        self.publish_timeout = config.get('publish_timeout', 60)
         self.pubsub_client = PubSubClient(
             config['service_account_file'],
             config['project_id'],
             config['topic_id']
         )
-        self.fetcher = StopEventFetcher(self.base_url)
+        self.fetcher = StopEventFetcher(self.base_url, max_workers=self.max_workers)
         self.logger, self.error_logger = LoggerSetup.init()
         self.error_dir = f'data/publisher_stop/errors/{self.date.year}/{self.date.month}'
         os.makedirs(self.error_dir, exist_ok=True)
@@ -88,49 +114,73 @@ class StopEventPublisher:
         with open(f'{self.error_dir}/{self.date.day}.txt', 'a') as f:
             f.write(f"{vehicle_id}\n")
 
+    def fetch(self, vehicle_id):
+        self.logger.info(f'Fetching stop events for Vehicle {vehicle_id}')
+        return self.fetcher.fetch_tree(vehicle_id)
+
+    def publish_vehicle(self, vehicle_id, root):
+        vehicle_count = 0
+        if root is None:
+            self.logger.warning(f"No data for vehicle {vehicle_id}")
+            return vehicle_count
+
+        sections = self.fetcher.parse_tables(root)
+        if not sections:
+            self.logger.warning(f"No table found for vehicle {vehicle_id}")
+            return vehicle_count
+
+        futures = []
+
+        for trip_id, table in sections:
+            # Only the header row and the first data row are used; don't materialize the rest
+            rows = table.xpath('(.//tr)[position() <= 2]')
+            if len(rows) <= 1:
+                continue
+
+            header_row, row = rows
+            header_len = int(header_row.xpath('count(.//th)'))
+
+            cols = [td.text_content().strip() for td in row.iterfind('.//td')]
+            if len(cols) != header_len:
+                self.logger.warning(f"Column/header mismatch for vehicle {vehicle_id}")
+                continue
+
+            cols.append(trip_id)  # Add trip_id value
+            futures.append(self.pubsub_client.publish('\t'.join(cols)))
+
+        # Wait once per vehicle so the client can batch and failures are not silently dropped
+        done, not_done = wait(futures, timeout=self.publish_timeout)
+        for future in done:
+            pub_e = future.exception()
+            if pub_e is None:
+                vehicle_count += 1
+            else:
+                self.logger.error(f"Error publishing message for vehicle {vehicle_id}: {pub_e}")
+        if not_done:
+            self.logger.error(f"{len(not_done)} messages for vehicle {vehicle_id} not published within {self.publish_timeout}s")
+
+        return vehicle_count
+
     def run(self):
         message_count = 0
         vehicle_message_counts = {}
         vehicles = VehicleLoader(self.vehicle_file).load()
 
-        for vehicle_id in vehicles:
-            self.logger.info(f'Fetching stop events for Vehicle {vehicle_id}')
-            vehicle_count = 0
-            try:
-                html = self.fetcher.fetch_html(vehicle_id)
-                if not html:
-                    self.logger.warning(f"No data for vehicle {vehicle_id}")
-                    continue
-
-                sections = self.fetcher.parse_tables(html)
-                if not sections:
-                    self.logger.warning(f"No table found for vehicle {vehicle_id}")
-                    continue
-
-                for trip_id, table in sections:
-                    rows = table.find_all('tr')
-                    if len(rows) <= 1:
-                        continue
-
-                    header = [th.get_text(strip=True) for th in rows[0].find_all('th')]
-                    header.append('trip_id')  # Add trip_id column
-
-                    row = rows[1]
-                    cols = [td.get_text(strip=True) for td in row.find_all('td')]
-                    if len(cols) != len(header) - 1: 
-                        self.logger.warning(f"Column/header mismatch for vehicle {vehicle_id}")
-                        continue
-
-                    cols.append(trip_id)  # Add trip_id value
-                    self.pubsub_client.publish('\t'.join(cols))
-                    message_count += 1
-                    vehicle_count += 1
-
-            except Exception as e:
-                self.log_error(e, vehicle_id)
-
-            vehicle_message_counts[vehicle_id] = vehicle_count
-            self.logger.info(f"Published {vehicle_count} messages for vehicle {vehicle_id}")
+        # Fetch concurrently; parse and publish each vehicle as its page arrives
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            fut_to_vehicle = {executor.submit(self.fetch, vehicle_id): vehicle_id for vehicle_id in vehicles}
+
+            for future in as_completed(fut_to_vehicle):
+                vehicle_id = fut_to_vehicle[future]
+                vehicle_count = 0
+                try:
+                    vehicle_count = self.publish_vehicle(vehicle_id, future.result())
+                except Exception as e:
+                    self.log_error(e, vehicle_id)
+
+                message_count += vehicle_count
+                vehicle_message_counts[vehicle_id] = vehicle_count
+                self.logger.info(f"Published {vehicle_count} messages for vehicle {vehicle_id}")
 
         self.logger.info("=== Per-Vehicle Message Count Summary ===")
         for v_id, count in vehicle_message_counts.items():
@@ -1,13 +1,18 @@
 from load_to_postgres import load_breadcrumb_data
 
+import atexit
 import datetime
+import itertools
 import timeit
 import os
-import json
+import orjson
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from google.cloud import pubsub_v1
 from google.oauth2 import service_account
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import threading
@@ -15,12 +20,21 @@ import signal
 import time
 
 # Global variables
-df_lock = threading.Lock()
-message_buffer = []
+warning_sample_size = 5  # Row indices / trip ids quoted in an aggregated warning
+flush_lock = threading.Lock()  # Serializes buffer flushes; appends are lock-free
+message_buffer = deque()
 last_message_time = datetime.datetime.now()
-COUNT = 0
+message_counter = itertools.count(1)  # next() is atomic, so callback threads need no lock
 idle_check_interval = 60  # Check idle time every 60 seconds
 idle_threshold = 180  # 3 minutes threshold for idle period
+MAX_BUFFER = 50_000  # Flush without waiting for idle time once this many messages are buffered
+buffer_full = threading.Event()  # Set by the callbacks to wake the flush thread early
+
+# Breadcrumb fields kept from each message; everything except OPD_DATE is numeric
+COLS = ("EVENT_NO_TRIP", "VEHICLE_ID", "ACT_TIME", "OPD_DATE", "METERS", "GPS_LATITUDE", "GPS_LONGITUDE", "GPS_HDOP")
+NUMERIC_COLS = tuple(col for col in COLS if col != "OPD_DATE")
+# Identifier columns stored as categoricals, so grouping and uniqueness checks work on integer codes
+CATEGORICAL_COLS = ("EVENT_NO_TRIP", "VEHICLE_ID")
 
 # Logging setup
 date = datetime.datetime.now()
@@ -44,8 +58,12 @@ error_handler = logging.FileHandler(error_log_file_path)
 error_handler.setLevel(logging.ERROR)
 error_handler.setFormatter(formatter)
 
-logger.addHandler(info_handler)
-logger.addHandler(error_handler)
+# Callers only enqueue records; a single listener thread writes them to the log files
+log_queue = queue.Queue(-1)
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, info_handler, error_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued log records on any interpreter exit
 
 # Service account file and subscription info
 SERVICE_ACCOUNT_FILE = os.path.join(os.path.dirname(__file__), "pubsubkey.json")
@@ -54,21 +72,27 @@ subscription_id = "bus-data-sub"
 
 # Increment message count and log every 10,000 messages
 def increment_message_count():
-    global COUNT
-    COUNT += 1
-    if COUNT % 10000 == 0:
-        logger.info(f"Received {COUNT} messages.")
+    count = next(message_counter)
+    if count % 10000 == 0:
+        logger.info(f"Received {count} messages.")
 
-# Process and save messages when idle for 3 minutes
+# Process and save messages when idle for 3 minutes, or as soon as the buffer reaches MAX_BUFFER
 def process_and_save():
-    global message_buffer
     while True:
-        time.sleep(idle_check_interval)
+        woken = buffer_full.wait(timeout=idle_check_interval)
+        buffer_full.clear()
+        if woken:
+            with flush_lock:
+                if len(message_buffer) >= MAX_BUFFER:
+                    logger.info(f"Buffer reached {MAX_BUFFER} messages. Running validation and saving data.")
+                    process_buffer()
+            continue
+
         current_time = datetime.datetime.now()
         time_since_last_message = (current_time - last_message_time).total_seconds()
 
         if time_since_last_message >= idle_threshold:
-            with df_lock:
+            with flush_lock:
                 if message_buffer:
                     logger.info("Detected 3 minutes of idle time. Running validation and saving data.")
                     process_buffer()
@@ -77,18 +101,19 @@ def process_and_save():
 
 # Pub/Sub message processing
 def process_message(json_obj):
-    global message_buffer, last_message_time
+    global last_message_time
     try:
-        with df_lock:
-            message_buffer.append(json_obj)
-            increment_message_count()
+        message_buffer.append(json_obj)  # deque.append is thread-safe
+        if len(message_buffer) >= MAX_BUFFER:
+            buffer_full.set()
+        increment_message_count()
         last_message_time = datetime.datetime.now()  # Update the last message time
     except Exception as e:
         logger.error(f"Error processing message: {e}")
 
 def callback(message: pubsub_v1.subscriber.message.Message) -> None:
     try:
-        json_obj = json.loads(message.data.decode("utf-8"))
+        json_obj = orjson.loads(message.data)  # Parses the raw bytes, no decode needed
         process_message(json_obj)
         message.ack()
     except Exception as e:
@@ -102,49 +127,53 @@ def check_required_fields(df: pd.DataFrame):
         if field not in df.columns or df[field].isnull().any():
             logger.warning(f"[EXISTENCE ASSERTION WARNING] Missing or null {field}")
     
-# Limit Assertion: ACT_TIME should be between 0 and 97200 (until 3AM on the next day)
-def check_act_time_limits(df: pd.DataFrame):
+# Limit and Intra-Record Assertions, built as masks in one pass and logged as one summary line each:
+# ACT_TIME should be between 0 and 97200 (until 3AM on the next day), METERS should be non-negative (>= 0),
+# GPS_HDOP should be positive (> 0), and GPS_LATITUDE and GPS_LONGITUDE cannot both be zero
+def check_record_limits(df: pd.DataFrame):
+    checks = {}
     if "ACT_TIME" in df.columns:
-        invalid = df[(df["ACT_TIME"] < 0) | (df["ACT_TIME"] > 97200)]
-        for idx in invalid.index:
-            logger.warning(f"[LIMIT ASSERTION WARNING] Invalid ACT_TIME: {df.at[idx, 'ACT_TIME']}")
-
-# Limit Assertion: METERS should be non-negative (>= 0)
-def check_meters_non_negative(df: pd.DataFrame):
+        act_time = df["ACT_TIME"]
+        checks["[LIMIT ASSERTION WARNING] Invalid ACT_TIME"] = (act_time < 0) | (act_time > 97200)
     if "METERS" in df.columns:
-        invalid = df[df["METERS"] < 0]
-        for idx in invalid.index:
-            logger.warning(f"[LIMIT ASSERTION WARNING] Invalid METERS: {df.at[idx, 'METERS']}")
-
-# Limit Assertion: GPS_HDOP should be positive (> 0)
-def check_gps_hdop_positive(df: pd.DataFrame):
+        checks["[LIMIT ASSERTION WARNING] Invalid METERS"] = df["METERS"] < 0
     if "GPS_HDOP" in df.columns:
-        invalid = df[df["GPS_HDOP"] <= 0]
-        for idx in invalid.index:
-            logger.warning(f"[LIMIT ASSERTION WARNING] Invalid GPS_HDOP: {df.at[idx, 'GPS_HDOP']}")
-
-# Intra-Record Assertion: GPS_LATITUDE and GPS_LONGITUDE cannot both be zero 
-def check_zero_gps_coordinates(df: pd.DataFrame):
+        checks["[LIMIT ASSERTION WARNING] Invalid GPS_HDOP"] = df["GPS_HDOP"] <= 0
     if "GPS_LATITUDE" in df.columns and "GPS_LONGITUDE" in df.columns:
-        zero_gps = df[(df["GPS_LATITUDE"] == 0) & (df["GPS_LONGITUDE"] == 0)]
-        for idx in zero_gps.index:
-            logger.warning(f"[INTRA RECORD ASSERTION WARNING] Both GPS_LATITUDE and GPS_LONGITUDE are zero in row {idx}")
+        checks["[INTRA RECORD ASSERTION WARNING] Both GPS_LATITUDE and GPS_LONGITUDE are zero"] = (
+            (df["GPS_LATITUDE"] == 0) & (df["GPS_LONGITUDE"] == 0)
+        )
+
+    for label, mask in checks.items():
+        count = int(mask.sum())
+        if count:
+            sample = df.index[mask.to_numpy()][:warning_sample_size].tolist()
+            logger.warning(f"{label} in {count} rows; sample idx={sample}")
 
 # Inter-Record Assertion: For the same EVENT_NO_TRIP, METERS should increase or remain constant
 def check_monotonic_meters(df: pd.DataFrame):
     if "EVENT_NO_TRIP" in df.columns and "METERS" in df.columns and "ACT_TIME" in df.columns:
-        for trip_id, group in df.groupby("EVENT_NO_TRIP"):
-            meters = group.sort_values("ACT_TIME")["METERS"]
-            if not meters.is_monotonic_increasing:
-                logger.warning(f"[INTER RECORD ASSERTION WARNING] METERS not monotonic for trip {trip_id}")
+        # One sort of the needed columns, then a grouped diff: a drop (or a missing value) breaks monotonicity
+        ordered = df[["EVENT_NO_TRIP", "ACT_TIME", "METERS"]].sort_values(["EVENT_NO_TRIP", "ACT_TIME"])
+        broken = ordered.groupby("EVENT_NO_TRIP", observed=True)["METERS"].diff().lt(0) | ordered["METERS"].isna()
+        broken &= ordered["EVENT_NO_TRIP"].notna()
+        trips = ordered.loc[broken, "EVENT_NO_TRIP"].unique()
+        if len(trips):
+            logger.warning(
+                f"[INTER RECORD ASSERTION WARNING] METERS not monotonic for {len(trips)} trips; "
+                f"sample trips={trips[:warning_sample_size].tolist()}"
+            )
 
 # Referential Integrity Assertion: VEHICLE_ID should be matched across all rows with the same EVENT_NO_TRIP
 def check_vehicle_id_consistency(df: pd.DataFrame):
     if "EVENT_NO_TRIP" in df.columns and "VEHICLE_ID" in df.columns:
-        mismatches = df.groupby("EVENT_NO_TRIP")["VEHICLE_ID"].nunique()
-        for trip_id, count in mismatches.items():
-            if count > 1:
-                logger.warning(f"[REFERENTIAL INTEGRITY ASSERTION WARNING] Multiple VEHICLE_IDs for trip {trip_id}")
+        vehicle_counts = df.groupby("EVENT_NO_TRIP", observed=True)["VEHICLE_ID"].nunique()
+        mismatches = vehicle_counts.index[vehicle_counts.to_numpy() > 1]
+        if len(mismatches):
+            logger.warning(
+                f"[REFERENTIAL INTEGRITY ASSERTION WARNING] Multiple VEHICLE_IDs for {len(mismatches)} trips; "
+                f"sample trips={mismatches[:warning_sample_size].tolist()}"
+            )
 
 # Limit Assertion: LATITUDE and LONGITUDE should not be NULL
 def remove_null_gps_coordinates(df: pd.DataFrame) -> pd.DataFrame:
@@ -182,11 +211,9 @@ def assert_trip_transitions(df: pd.DataFrame) -> None:
         logger.warning("[SUMMARY ASSERTION] EVENT_NO_TRIP column missing.")
         return
 
-    event_trip_list = df["EVENT_NO_TRIP"].tolist()
-    transition_count = 1 if event_trip_list else 0
-    for i in range(1, len(event_trip_list)):
-        if event_trip_list[i] != event_trip_list[i - 1]:
-            transition_count += 1
+    # Count the rows whose EVENT_NO_TRIP differs from the previous row, plus the first row
+    event_trips = df["EVENT_NO_TRIP"].to_numpy()
+    transition_count = int(np.count_nonzero(event_trips[1:] != event_trips[:-1])) + (1 if event_trips.size else 0)
 
     unique_trips = df["EVENT_NO_TRIP"].nunique()
 
@@ -202,37 +229,39 @@ def assert_trip_transitions(df: pd.DataFrame) -> None:
 def run_all_validations(df: pd.DataFrame):
     validation_functions = [
         check_required_fields,
-        check_act_time_limits,
-        check_meters_non_negative,
-        check_gps_hdop_positive,
-        check_zero_gps_coordinates,
+        check_record_limits,
         check_monotonic_meters,
         check_vehicle_id_consistency
     ]
 
-    for func in validation_functions:
+    def run_validation(func):
         try:
             func(df)
         except Exception as e:
             logger.error(f"Validation function {func.__name__} failed: {e}")
 
-# Validate and extract date from OPD_DATE for add_tstamp_column
-def extract_date(opd_date_str):
-    if isinstance(opd_date_str, str) and ':' in opd_date_str:
-        try:
-            date_part = opd_date_str.split(':')[0]
-            return datetime.datetime.strptime(date_part, "%d%b%Y").date()
-        except Exception:
-            return None
-    return None
+    # The checks only read df and spend their time in pandas/NumPy, so they can run side by side
+    with ThreadPoolExecutor(max_workers=len(validation_functions)) as executor:
+        list(executor.map(run_validation, validation_functions))
 
 # Transformation functions
 def add_tstamp_column(df: pd.DataFrame) -> pd.DataFrame:
     try:
         logger.info("Extracting OPD_DATE...") 
-        # Apply extraction and handle missing values
-        df['OPD_DATE'] = df['OPD_DATE'].apply(extract_date)
-        df["OPD_DATE"] = df["OPD_DATE"].fillna(method='ffill').fillna(method='bfill')
+        # A buffer holds only a handful of distinct OPD_DATE strings (e.g. 08DEC2022:00:00:00), so parse
+        # each distinct value once and map the results back by code; values without ':' or that don't
+        # parse become missing, then handle missing values
+        codes, unique_dates = pd.factorize(df['OPD_DATE'])
+        opd_date = pd.Series(unique_dates).astype('string')
+        date_part = opd_date.str.split(':', n=1).str[0].where(opd_date.str.contains(':', regex=False))
+        parsed = pd.to_datetime(date_part, format="%d%b%Y", errors='coerce').dt.date.to_numpy(dtype=object)
+        valid_dates = pd.unique(parsed[pd.notna(parsed)])
+        if len(valid_dates) == 1:
+            # Common case: the whole buffer is one service day, so every row (missing ones included) gets it
+            df['OPD_DATE'] = valid_dates[0]
+        else:
+            opd_dates = pd.Series(np.append(parsed, pd.NaT)[codes], index=df.index)  # code -1 (missing OPD_DATE) picks the trailing NaT
+            df['OPD_DATE'] = opd_dates.ffill().bfill()
 
         # Ensure OPD_DATE is in datetime.date format
         df['OPD_DATE'] = pd.to_datetime(df['OPD_DATE'], errors='coerce').dt.date
@@ -253,52 +282,68 @@ def add_tstamp_column(df: pd.DataFrame) -> pd.DataFrame:
         return df
     return df
 
-# Compute speed within each trip for add_speed_column
-def compute_speed(group):
-    meters = group["METERS"].values
-    times = group["ACT_TIME"].values
-    speeds = [0.0]
-    for i in range(1, len(group)):
-        delta_m = meters[i] - meters[i - 1]
-        delta_t = times[i] - times[i - 1]
-        speed = delta_m / delta_t if delta_t > 0 else 0.0
-        speeds.append(speed)
-    if len(speeds) > 1:
-        speeds[0] = speeds[1]  # set first breadcrumb's speed = second breadcrumb's speed
-    group["SPEED"] = speeds
-    return group
-
-
 def add_speed_column(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.sort_values(by=["TSTAMP", "EVENT_NO_TRIP"])
-    df["SPEED"] = 0.0  # default speed
+    # Rows without a trip are dropped, as groupby would; then group rows by trip in time order
+    df = df[df["EVENT_NO_TRIP"].notna()].sort_values(by=["EVENT_NO_TRIP", "TSTAMP"])
+
+    trips = df["EVENT_NO_TRIP"].to_numpy()
+    meters = df["METERS"].to_numpy(dtype=np.float64)
+    times = df["ACT_TIME"].to_numpy(dtype=np.float64)
+
+    # A row starts a trip when its EVENT_NO_TRIP differs from the previous row's
+    starts = np.ones(len(df), dtype=bool)
+    starts[1:] = trips[1:] != trips[:-1]
+
+    delta_m = np.diff(meters, prepend=meters[:1])
+    delta_t = np.diff(times, prepend=times[:1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speeds = np.where(~starts & (delta_t > 0), delta_m / delta_t, 0.0)
+
+    # set first breadcrumb's speed = second breadcrumb's speed, for trips with two or more rows
+    first = np.flatnonzero(starts)
+    second = first + 1
+    multi = second < len(speeds)
+    multi[multi] = ~starts[second[multi]]
+    speeds[first[multi]] = speeds[second[multi]]
+
+    df["SPEED"] = speeds
+    return df
 
-    df = df.groupby("EVENT_NO_TRIP", group_keys=False).apply(compute_speed)
+# Narrow numeric columns to the smallest dtype that holds their values (e.g. ACT_TIME to int32) so the
+# validation and transformation passes scan fewer bytes; GPS coordinates stay float64, as float32 would
+# round them by up to half a metre
+def downcast(df: pd.DataFrame) -> pd.DataFrame:
+    for col in ("ACT_TIME", "METERS"):
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    df["GPS_HDOP"] = pd.to_numeric(df["GPS_HDOP"], downcast='float')
     return df
 
-# Helper function for add_service_key_column
-def get_service_key(date):
-    # Get day of the week (0=Monday, 1=Tuesday, ..., 6=Sunday)
-    day_of_week = date.weekday()  # Monday=0, Sunday=6
-    if day_of_week == 5:  # Saturday
-        return "Saturday"
-    elif day_of_week == 6:  # Sunday
-        return "Sunday"
-    else:  # Weekday (Monday to Friday)
-        return "Weekday"
+# Service key for each day of the week (0=Monday, 1=Tuesday, ..., 6=Sunday)
+SERVICE_KEYS = np.array(["Weekday"] * 5 + ["Saturday", "Sunday"])
 
 def add_service_key_column(df: pd.DataFrame) -> pd.DataFrame:
-    # Apply the service key based on TSTAMP
-    df["SERVICE_KEY"] = df["TSTAMP"].apply(lambda x: get_service_key(x))
+    # Look up the service key based on TSTAMP's day of week; a missing TSTAMP counts as a weekday
+    day_of_week = pd.to_datetime(df["TSTAMP"]).dt.dayofweek.fillna(0).to_numpy(dtype=np.int64)
+    df["SERVICE_KEY"] = pd.Categorical(SERVICE_KEYS[day_of_week])
 
     return df
 
 # Process the buffered messages
 def process_buffer():
-    global message_buffer
     try:
-        df = pd.DataFrame(message_buffer)
-        message_buffer = []  # Clear the buffer
+        # Drain only what is buffered now; callbacks may keep appending meanwhile
+        messages = [message_buffer.popleft() for _ in range(len(message_buffer))]
+
+        # Pivot the messages into one array per column rather than letting pandas sniff a list of dicts
+        columns = {
+            col: np.fromiter((m.get(col) for m in messages), dtype=object, count=len(messages))
+            for col in COLS
+        }
+        for col in NUMERIC_COLS:
+            columns[col] = pd.to_numeric(columns[col], errors='coerce')
+        for col in CATEGORICAL_COLS:
+            columns[col] = pd.Categorical(columns[col])
+        df = downcast(pd.DataFrame(columns, copy=False))
 
         if df is None or df.empty:
             logger.warning("DataFrame is None or empty.")
@@ -337,7 +382,7 @@ def process_buffer():
 # Set up signal handling for graceful shutdown on SIGTERM
 def shutdown_signal_handler(signum, frame):
     logger.info("SIGTERM received. Processing remaining messages before shutdown.")
-    with df_lock:
+    with flush_lock:
         process_buffer()
     logger.info("Graceful shutdown complete.")
     exit(0)  # Exit cleanly
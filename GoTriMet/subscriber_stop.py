@@ -41,6 +41,15 @@ class LoggerSetup:
 
         return logger, error_logger
 
+# stop_event columns and the tab-separated message field each one is read from
+STOP_EVENT_FIELDS = {
+    "trip_id": -1,
+    "vehicle_number": 0,
+    "route_number": 3,
+    "service_key": 5,
+    "direction": 4,
+}
+
 class StopEventSubscriber:
     def __init__(self, config):
         self.logger, self.error_logger = LoggerSetup.init()
@@ -48,7 +57,8 @@ class StopEventSubscriber:
         self.shutdown_event = threading.Event()
         self.last_message_time = datetime.datetime.now()
         self.received_any_message = False
-        self.rows = [] # raw incoming messages
+        self.columns = self.new_columns() # needed message fields, one list per column
+        self.columns_lock = threading.Lock() # keeps the column lists aligned across callback threads
 
         creds = service_account.Credentials.from_service_account_file(config["service_account_file"])
         self.subscriber = pubsub_v1.SubscriberClient(credentials=creds)
@@ -56,10 +66,21 @@ class StopEventSubscriber:
             config["project_id"], config["subscription_id"]
         )
 
+    @staticmethod
+    def new_columns():
+        return {column: [] for column in STOP_EVENT_FIELDS}
+
     def callback(self, message):
         try:
             decoded = message.data.decode('utf-8').strip().split('\t')
-            self.rows.append(decoded)
+            if len(decoded) < 6:
+                self.error_logger.error(f"Skipping message with {len(decoded)} fields, expected at least 6.")
+                message.ack()
+                return
+
+            with self.columns_lock:
+                for column, index in STOP_EVENT_FIELDS.items():
+                    self.columns[column].append(decoded[index])
             self.received_any_message = True
             self.last_message_time = datetime.datetime.now()  # Update last message time
             message.ack()
@@ -79,28 +100,22 @@ class StopEventSubscriber:
             self.shutdown_event.wait(timeout=60)
 
     def save_and_load_data(self):
-        if not self.rows:
+        # Take the collected columns and start fresh ones, so callbacks keep appending during the load
+        with self.columns_lock:
+            columns, self.columns = self.columns, self.new_columns()
+
+        if not columns["trip_id"]:
             self.logger.info("No rows collected. Skipping.")
             return
 
         try:
-            df = pd.DataFrame(self.rows)
-            if df.empty or df.shape[1] < 6:
-                self.logger.warning("Insufficient data. Skipping.")
-                self.rows.clear()
-                return
-
-            # Column selection and renaming
-            df = df.iloc[:, [ -1, 0, 3, 5, 4 ]] 
-            df.columns = ["trip_id", "vehicle_number", "route_number", "service_key", "direction"]
+            df = pd.DataFrame(columns, copy=False)
 
             load_stop_event_data(df)
             self.logger.info("Data successfully loaded into the database.")
 
         except Exception as e:
             self.error_logger.error(f"Failed to load data into the database: {e}")
-        finally:
-            self.rows.clear()
 
 
     def run(self):
@@ -127,8 +142,8 @@ class StopEventSubscriber:
         finally:
             self.logger.info("Final shutdown. Saving any remaining data.")
             self.save_and_load_data()
-            self.logger.info(f"Total messages processed: {len(self.rows)}")
-            print(f"Total messages processed: {len(self.rows)}")
+            self.logger.info(f"Total messages processed: {len(self.columns['trip_id'])}")
+            print(f"Total messages processed: {len(self.columns['trip_id'])}")
 
 if __name__ == "__main__":
     config = {
@@ -1,4 +1,4 @@
-from flask import Flask, render_template_string, send_from_directory
+from flask import Flask, send_from_directory
 from dotenv import load_dotenv
 import os
 
@@ -7,20 +7,32 @@ load_dotenv(os.path.expanduser("~/.env"))
 
 app = Flask(__name__)
 
+# Run under a WSGI server for anything beyond local testing, from this directory:
+#   gunicorn -w 4 -b 0.0.0.0:8000 server:app
+# gunicorn hands /data files to the kernel with sendfile(2). When a front-end server that honors
+# X-Sendfile serves the files instead, set USE_X_SENDFILE=1 so Flask only sends the header.
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
+
+# Read the visual HTML files (visual1 to visual7) once, with the Mapbox token already filled in;
+# they are static pages, so there is nothing else to render per request
+def load_visuals():
+    mapbox_token = os.getenv("MAPBOX_TOKEN", "")
+    visuals = {}
+    for n in range(1, 8):
+        filename = f"visual{n}.html"
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                visuals[n] = f.read().replace("{{ MAPBOX_TOKEN }}", mapbox_token)
+    return visuals
+
+VISUALS = load_visuals()
+
 # Serve individual visual HTML files (from visual1 to visual7)
 @app.route("/visual<int:n>")
 def serve_visual(n):
-    mapbox_token = os.getenv("MAPBOX_TOKEN")
-    filename = f"visual{n}.html"
-    
-    if not os.path.exists(filename):
-        return f"{filename} not found", 404
-    
-    with open(filename, "r") as f:
-        html_content = f.read()
-    
-    html_content = html_content.replace("{{ MAPBOX_TOKEN }}", mapbox_token)
-    return render_template_string(html_content)
+    if n not in VISUALS:
+        return f"visual{n}.html not found", 404
+    return VISUALS[n]
 
 # Serve GeoJSON and other static files from /data/
 @app.route("/data/<path:path>")
@@ -43,5 +55,6 @@ def index():
     </ul>
     """
 
+# Flask development server, for local testing only
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=8000)
@@ -1,6 +1,11 @@
 #!/usr/bin/python3
-import csv, json, sys
-from geojson import Feature, FeatureCollection, Point
+import os
+import sys
+import numpy as np
+import orjson
+import pandas as pd
+
+CHUNKSIZE = 50_000  # TSV rows parsed, converted and written at a time
 
 # Check usage
 if len(sys.argv) != 3:
@@ -10,61 +15,75 @@ if len(sys.argv) != 3:
 tsv_file = sys.argv[1]
 geojson_file = sys.argv[2]
 
-features = []
-
-with open(tsv_file, newline='') as csvfile:
-    reader = csv.DictReader(csvfile, delimiter='\t') 
-
-    for row in reader:
+# Yield a GeoJSON feature for each usable row of a TSV chunk
+def chunk_features(df):
+    metadata_keys = []
+
+    # Geo coordinates: standard names
+    if {'latitude', 'longitude', 'speed'}.issubset(df.columns):
+        lat, lon, speed = df['latitude'], df['longitude'], df['speed']
+
+        # Optional metadata
+        metadata_keys = [key for key in ['tstamp', 'trip_id', 'direction', 'service_key', 'weather'] if key in df.columns]
+
+    # Alternate x/y format
+    elif {'x', 'y', 'speed'}.issubset(df.columns):
+        lat, lon, speed = df['y'], df['x'], df['speed']
+
+    # Raw 4-column fallback (like data5.tsv)
+    elif len(df.columns) == 4:
+        lat, lon, speed = df.iloc[:, 0], df.iloc[:, 1], df.iloc[:, 2]
+        df = df.assign(weather=df.iloc[:, 3])
+        metadata_keys = ['weather']
+
+    else:
+        return
+
+    # Skip bad rows: any coordinate or speed that is not a finite number
+    coords = pd.DataFrame({
+        'lat': pd.to_numeric(lat, errors='coerce'),
+        'lon': pd.to_numeric(lon, errors='coerce'),
+        'speed': pd.to_numeric(speed, errors='coerce'),
+    })
+    valid = np.isfinite(coords.to_numpy()).all(axis=1)
+    coords = coords[valid]
+    metadata = df.loc[valid, metadata_keys].to_numpy(dtype=object).tolist()
+
+    # Points keep 6 decimal places, as geojson.Point does
+    for x, y, s, meta in zip(
+        coords['lon'].round(6).tolist(),
+        coords['lat'].round(6).tolist(),
+        coords['speed'].astype(int).tolist(),
+        metadata,
+    ):
+        yield {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [x, y]},
+            "properties": {"speed": s, **dict(zip(metadata_keys, meta))},
+        }
+
+# Stream the FeatureCollection one feature per line instead of holding every feature in memory.
+# Write to a temporary file next to the output and move it into place only once it is complete,
+# so a failed run leaves the previous GeoJSON untouched.
+tmp_file = f"{geojson_file}.tmp"
+try:
+    with open(tmp_file, "wb") as f:
+        f.write(b'{"type":"FeatureCollection","features":[\n')
+        separator = b""
         try:
-            props = {}
-            # Geo coordinates: standard names
-            if {'latitude', 'longitude', 'speed'}.issubset(row.keys()):
-                lat = float(row['latitude'])
-                lon = float(row['longitude'])
-                speed = float(row['speed'])
-                props['speed'] = int(speed)
-
-                # Optional metadata
-                for key in ['tstamp', 'trip_id', 'direction', 'service_key', 'weather']:
-                    if key in row:
-                        props[key] = row[key]
-
-                feature = Feature(geometry=Point((lon, lat)), properties=props)
-                features.append(feature)
-
-            # Alternate x/y format
-            elif {'x', 'y', 'speed'}.issubset(row.keys()):
-                lat = float(row['y'])
-                lon = float(row['x'])
-                speed = float(row['speed'])
-                props['speed'] = int(speed)
-
-                feature = Feature(geometry=Point((lon, lat)), properties=props)
-                features.append(feature)
-
-            # Raw 4-column fallback (like data5.tsv)
-            elif len(row) == 4:
-                try:
-                    lat = float(list(row.values())[0])
-                    lon = float(list(row.values())[1])
-                    speed = float(list(row.values())[2])
-                    weather = list(row.values())[3]
-
-                    props['speed'] = int(speed)
-                    props['weather'] = weather
-
-                    feature = Feature(geometry=Point((lon, lat)), properties=props)
-                    features.append(feature)
-                except (ValueError, IndexError):
-                    continue
-
-
-        except (ValueError, TypeError):
-            continue  # skip bad rows
-
-
-collection = FeatureCollection(features)
-
-with open(geojson_file, "w") as f:
-    json.dump(collection, f, indent=2)
+            # Read every field as the raw string; only the coordinates and speed are converted.
+            # Rows with more fields than the header are skipped like other bad rows.
+            for chunk in pd.read_csv(tsv_file, sep='\t', dtype=str, keep_default_na=False,
+                                     on_bad_lines='skip', chunksize=CHUNKSIZE):
+                for feature in chunk_features(chunk):
+                    f.write(separator)
+                    f.write(orjson.dumps(feature))
+                    separator = b",\n"
+        except pd.errors.EmptyDataError:
+            pass
+        f.write(b"\n]}\n")
+    os.replace(tmp_file, geojson_file)
+except BaseException:
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    raise